@@ -0,0 +1,188 @@
+import codecs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import os
+from pathlib import Path
+import stat
+import tempfile
+
+
+READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+_SCAN_CHUNK = 1 << 16
+
+DEFAULT_EXCLUDE_DIRS = frozenset({".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv"})
+
+
+def is_valid_utf8(data):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    view = memoryview(data)
+    try:
+        for start in range(0, len(view), _SCAN_CHUNK):
+            decoder.decode(view[start:start + _SCAN_CHUNK])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def is_ascii(data):
+    view = memoryview(data)
+    for start in range(0, len(view), _SCAN_CHUNK):
+        if not view[start:start + _SCAN_CHUNK].tobytes().isascii():
+            return False
+    return True
+
+
+def classify_bytes(data):
+    if data[:3] == b"\xef\xbb\xbf":
+        payload = memoryview(data)[3:]
+        if is_valid_utf8(payload):
+            return "utf8-bom", payload
+        return "utf8-bom-invalid", payload
+    if data[:2] == b"\xff\xfe":
+        return "utf16-le", data
+    if data[:2] == b"\xfe\xff":
+        return "utf16-be", data
+    if b"\x00" in data:
+        return "binary", data
+    if is_ascii(data):
+        return "ascii-only", data
+    if is_valid_utf8(data):
+        return "utf8", data
+    return "ansi-cp1252", data
+
+
+def classify(data):
+    label, _ = classify_bytes(data)
+    return label
+
+
+def decode_bytes(data, label):
+    if label == "utf8":
+        return data.decode("utf-8")
+    if label == "utf8-bom":
+        return data.decode("utf-8-sig")
+    if label == "ascii-only":
+        return data.decode("ascii")
+    if label == "ansi-cp1252":
+        return data.decode("cp1252")
+    if label in ("utf16-le", "utf16-be"):
+        return data.decode("utf-16")
+    return None
+
+
+def _scandir_recursive(path, exclude_dirs, include_hidden):
+    stack = [path]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in exclude_dirs:
+                            continue
+                        if not include_hidden and entry.name.startswith("."):
+                            continue
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+
+
+def normalize_extensions(extensions):
+    exts = set()
+    for ext in extensions:
+        ext = ext.strip()
+        if not ext:
+            continue
+        if not ext.startswith("."):
+            ext = "." + ext
+        exts.add(ext.lower())
+    return tuple(sorted(exts))
+
+
+def gather_files_and_backups(
+    root, exts, backup_ext, exclude_dirs=DEFAULT_EXCLUDE_DIRS, include_hidden=False
+):
+    entries = []
+    backups = set() if backup_ext else None
+    backup_suffix = backup_ext.casefold() if backup_ext else None
+    for entry in _scandir_recursive(root, exclude_dirs, include_hidden):
+        if entry.name.lower().endswith(exts):
+            entries.append(entry)
+        if backup_suffix and entry.name.casefold().endswith(backup_suffix):
+            backups.add(str(Path(entry.path)).casefold())
+    if os.name == "nt":
+        return sorted(Path(entry.path) for entry in entries), backups
+    entries.sort(key=lambda entry: (entry.inode(), entry.path))
+    return [Path(entry.path) for entry in entries], backups
+
+
+def gather_files(root, exts, exclude_dirs=DEFAULT_EXCLUDE_DIRS, include_hidden=False):
+    paths, _ = gather_files_and_backups(root, exts, None, exclude_dirs, include_hidden)
+    return paths
+
+
+def backup_exists(backup_path, existing_backups=None):
+    if existing_backups is not None and str(backup_path).casefold() not in existing_backups:
+        return False
+    return backup_path.exists()
+
+
+def read_files(paths, max_pending=2 * READ_WORKERS):
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(path.read_bytes)))
+            if len(pending) >= max_pending:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def _copy_owner(fd, st):
+    tmp_st = os.fstat(fd)
+    if (tmp_st.st_uid, tmp_st.st_gid) == (st.st_uid, st.st_gid):
+        return True
+    try:
+        os.chown(fd, st.st_uid, st.st_gid)
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+def write_bytes_atomic(path, data):
+    real_path = Path(os.path.realpath(path))
+    st = os.stat(real_path)
+    if st.st_nlink > 1:
+        real_path.write_bytes(data)
+        return
+    if not os.access(real_path, os.W_OK):
+        raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), str(path))
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=real_path.name + ".", suffix=".tmp", dir=real_path.parent
+        )
+    except OSError:
+        real_path.write_bytes(data)
+        return
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            owner_kept = _copy_owner(f.fileno(), st)
+        if not owner_kept:
+            tmp_path.unlink()
+            real_path.write_bytes(data)
+            return
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
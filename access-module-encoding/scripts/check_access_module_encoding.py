@@ -1,51 +1,43 @@
 #!/usr/bin/env python
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import os
 from pathlib import Path
 import sys
 
+from _encoding_core import (
+    DEFAULT_EXCLUDE_DIRS,
+    READ_WORKERS,
+    classify_bytes,
+    gather_files,
+    is_ascii,
+    normalize_extensions,
+)
 
-def _classify_bytes(data):
-    if data.startswith(b"\xef\xbb\xbf"):
-        try:
-            data[3:].decode("utf-8")
-            return "utf8-bom", data[3:]
-        except UnicodeDecodeError:
-            return "utf8-bom-invalid", data[3:]
-    if data.startswith(b"\xff\xfe"):
-        return "utf16-le", data
-    if data.startswith(b"\xfe\xff"):
-        return "utf16-be", data
-    if b"\x00" in data:
-        return "binary", data
-    try:
-        data.decode("utf-8")
-        return "utf8", data
-    except UnicodeDecodeError:
-        return "ansi-cp1252", data
 
+_MMAP_THRESHOLD = 1 << 16
 
-def classify_file(path):
-    data = path.read_bytes()
-    label, payload = _classify_bytes(data)
-    non_ascii = any(b >= 0x80 for b in payload)
-    if not non_ascii:
+_PROBLEM_LABELS = frozenset({"utf8-bom", "utf8-bom-invalid", "utf16-le", "utf16-be", "binary"})
+_TEXT_LABELS = frozenset({"utf8", "ansi-cp1252"})
+
+
+def _classify_data(data):
+    label, payload = classify_bytes(data)
+    if label in _TEXT_LABELS:
+        return label, len(data), True, True
+    if label == "ascii-only" or is_ascii(payload):
         return "ascii-only", len(data), False, True
-    return label, len(data), non_ascii, True
+    return label, len(data), True, True
 
 
-def gather_files(root, extensions):
-    exts = []
-    for ext in extensions:
-        ext = ext.strip()
-        if not ext:
-            continue
-        if not ext.startswith("."):
-            ext = "." + ext
-        exts.append(ext.lower())
-    files = []
-    for ext in exts:
-        files.extend(root.rglob(f"*{ext}"))
-    return sorted(set(files))
+def classify_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_THRESHOLD:
+            return _classify_data(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _classify_data(data)
 
 
 def main():
@@ -68,6 +60,18 @@ def main():
         default=[".bas", ".cls"],
         help="Extensions to scan when no files are provided.",
     )
+    parser.add_argument(
+        "--exclude-dir",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Directory name to skip when scanning (repeatable). VCS, cache and venv directories are always skipped.",
+    )
+    parser.add_argument(
+        "--include-hidden",
+        action="store_true",
+        help="Also scan directories whose name starts with a dot.",
+    )
     parser.add_argument(
         "--strict",
         action="store_true",
@@ -82,42 +86,51 @@ def main():
         if not root.exists():
             print(f"root-not-found: {root}", file=sys.stderr)
             return 2
-        paths = gather_files(root, args.extensions)
+        paths = gather_files(
+            root,
+            normalize_extensions(args.extensions),
+            DEFAULT_EXCLUDE_DIRS | frozenset(args.exclude_dir),
+            args.include_hidden,
+        )
 
     if not paths:
         print("no-files-found", file=sys.stderr)
         return 2
+    if args.files:
+        paths = [path for path in paths if path.is_file()]
 
     results = []
-    for path in paths:
-        if not path.is_file():
-            continue
-        label, size, non_ascii, ok = classify_file(path)
-        results.append((path, size, label, non_ascii, ok))
-
-    print("file\tbytes\tclass\tnon_ascii")
-    for path, size, label, non_ascii, _ in results:
-        print(f"{path}\t{size}\t{label}\t{non_ascii}")
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        for path, result in zip(paths, executor.map(classify_file, paths)):
+            label, size, non_ascii, ok = result
+            results.append((path, size, label, non_ascii, ok))
+    if not args.files:
+        results.sort(key=lambda result: result[0])
+
+    lines = ["file\tbytes\tclass\tnon_ascii"]
+    lines.extend(
+        f"{path}\t{size}\t{label}\t{non_ascii}"
+        for path, size, label, non_ascii, _ in results
+    )
+    sys.stdout.write("\n".join(lines) + "\n")
 
-    counts = {}
-    for _, _, label, _, _ in results:
-        counts[label] = counts.get(label, 0) + 1
+    counts = Counter(label for _, _, label, _, _ in results)
 
     text_encs = set()
     problem = False
     for label in counts:
-        if label in ("utf8-bom", "utf8-bom-invalid", "utf16-le", "utf16-be", "binary"):
+        if label in _PROBLEM_LABELS:
             problem = True
-        if label in ("utf8", "ansi-cp1252"):
+        if label in _TEXT_LABELS:
             text_encs.add(label)
 
     mixed_text = len(text_encs) > 1
 
-    print("\nsummary:")
-    for label in sorted(counts):
-        print(f"{label}\t{counts[label]}")
-    print(f"mixed_text_encodings\t{mixed_text}")
-    print(f"problem_encodings\t{problem}")
+    lines = ["", "summary:"]
+    lines.extend(f"{label}\t{counts[label]}" for label in sorted(counts))
+    lines.append(f"mixed_text_encodings\t{mixed_text}")
+    lines.append(f"problem_encodings\t{problem}")
+    sys.stdout.write("\n".join(lines) + "\n")
 
     if args.strict and (mixed_text or problem):
         return 1
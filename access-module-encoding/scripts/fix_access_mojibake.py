@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 import argparse
+from collections import Counter
 import json
 from pathlib import Path
+import re
 import sys
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+from _encoding_core import (
+    DEFAULT_EXCLUDE_DIRS,
+    backup_exists,
+    classify,
+    decode_bytes,
+    gather_files_and_backups,
+    normalize_extensions,
+    read_files,
+    write_bytes_atomic,
+)
+
 
 SUSPICIOUS_TOKENS = [
     "\u00c3",
@@ -49,46 +67,12 @@ SPANISH_DEFAULTS = {
     "T\ufffdCNICA": "T\u00c9CNICA",
 }
 
-def _classify_bytes(data):
-    if data.startswith(b"\xef\xbb\xbf"):
-        try:
-            data[3:].decode("utf-8")
-            return "utf8-bom", data[3:]
-        except UnicodeDecodeError:
-            return "utf8-bom-invalid", data[3:]
-    if data.startswith(b"\xff\xfe"):
-        return "utf16-le", data
-    if data.startswith(b"\xfe\xff"):
-        return "utf16-be", data
-    if b"\x00" in data:
-        return "binary", data
-    try:
-        data.decode("utf-8")
-        return "utf8", data
-    except UnicodeDecodeError:
-        return "ansi-cp1252", data
-
+_SKIP_LABELS = frozenset({"binary", "utf8-bom-invalid"})
 
-def classify(data):
-    label, payload = _classify_bytes(data)
-    if label in ("utf8", "ansi-cp1252"):
-        if not any(b >= 0x80 for b in payload):
-            return "ascii-only"
-    return label
+_NON_ASCII_RUN_RE = re.compile(r"[^\x00-\x7f]+")
 
-
-def decode_bytes(data, label):
-    if label == "utf8":
-        return data.decode("utf-8")
-    if label == "utf8-bom":
-        return data.decode("utf-8-sig")
-    if label == "ascii-only":
-        return data.decode("ascii")
-    if label == "ansi-cp1252":
-        return data.decode("cp1252")
-    if label in ("utf16-le", "utf16-be"):
-        return data.decode("utf-16")
-    return None
+_MAP_PATTERNS = {}
+_MAP_AUTOMATA = {}
 
 
 def encode_text(text, label):
@@ -99,104 +83,155 @@ def encode_text(text, label):
     return text.encode("utf-8")
 
 
-def gather_files(root, extensions):
-    exts = []
-    for ext in extensions:
-        ext = ext.strip()
-        if not ext:
-            continue
-        if not ext.startswith("."):
-            ext = "." + ext
-        exts.append(ext.lower())
-    files = []
-    for ext in exts:
-        files.extend(root.rglob(f"*{ext}"))
-    return sorted(set(files))
-
-
 def mojibake_score(text):
     return sum(text.count(token) for token in SUSPICIOUS_TOKENS)
 
 
-def fix_utf8_in_cp1252(text):
+def _cp1252_round_trip(text):
+    if "\ufffd" in text:
+        return None
     try:
-        repaired = text.encode("cp1252").decode("utf-8")
+        return text.encode("cp1252").decode("utf-8")
     except (UnicodeEncodeError, UnicodeDecodeError):
-        repaired = None
-    if repaired is not None:
-        if mojibake_score(repaired) < mojibake_score(text):
-            return repaired, True
-        return text, False
-
-    lines = text.splitlines(keepends=True)
-    new_lines = []
-    changed = False
-    for line in lines:
-        try:
-            repaired_line = line.encode("cp1252").decode("utf-8")
-        except (UnicodeEncodeError, UnicodeDecodeError):
-            new_lines.append(line)
-            continue
-        if mojibake_score(repaired_line) < mojibake_score(line):
-            new_lines.append(repaired_line)
-            changed = True
-        else:
-            new_lines.append(line)
-    if not changed:
-        return text, False
-    repaired = "".join(new_lines)
-    if mojibake_score(repaired) < mojibake_score(text):
-        return repaired, True
-    return text, False
+        return None
 
 
-def apply_map(text, mapping):
+def fix_utf8_in_cp1252(text, score=None):
+    if score is None:
+        score = mojibake_score(text)
+    if not score:
+        return text, False, score
+    repaired = _cp1252_round_trip(text)
+    if repaired is not None:
+        repaired_score = mojibake_score(repaired)
+        if repaired_score < score:
+            return repaired, True, repaired_score
+        return text, False, score
+
+    parts = []
+    last_end = 0
+    repaired_score = score
+    for match in _NON_ASCII_RUN_RE.finditer(text):
+        run = match.group(0)
+        run_score = mojibake_score(run)
+        if not run_score:
+            continue
+        repaired_run = _cp1252_round_trip(run)
+        if repaired_run is None:
+            continue
+        repaired_run_score = mojibake_score(repaired_run)
+        if repaired_run_score < run_score:
+            parts.append(text[last_end:match.start()])
+            parts.append(repaired_run)
+            last_end = match.end()
+            repaired_score -= run_score - repaired_run_score
+    if repaired_score == score:
+        return text, False, score
+    parts.append(text[last_end:])
+    return "".join(parts), True, repaired_score
+
+
+def _map_pattern(mapping):
+    cached = _MAP_PATTERNS.get(id(mapping))
+    if cached is not None and cached[1] is mapping:
+        return cached[0]
+    keys = sorted((key for key in mapping if key), key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(key) for key in keys))
+    _MAP_PATTERNS[id(mapping)] = (pattern, mapping)
+    return pattern
+
+
+def _map_automaton(mapping):
+    cached = _MAP_AUTOMATA.get(id(mapping))
+    if cached is not None and cached[1] is mapping:
+        return cached[0]
+    automaton = ahocorasick.Automaton()
     for key, value in mapping.items():
-        text = text.replace(key, value)
-    return text
+        if key:
+            automaton.add_word(key, (len(key), value))
+    automaton.make_automaton()
+    _MAP_AUTOMATA[id(mapping)] = (automaton, mapping)
+    return automaton
 
 
-def normalize_file(path, apply, backup, backup_ext, fix_utf8, mapping, apply_map_flag):
-    data = path.read_bytes()
+def apply_map(text, mapping):
+    if len(mapping) == 1:
+        ((key, value),) = mapping.items()
+        return text.replace(key, value) if key else text
+    if ahocorasick is None:
+        return _map_pattern(mapping).sub(lambda m: mapping[m.group(0)], text)
+    matches = sorted(
+        (end - length + 1, -length, value)
+        for end, (length, value) in _map_automaton(mapping).iter(text)
+    )
+    parts = []
+    last_end = 0
+    for start, neg_length, value in matches:
+        if start < last_end:
+            continue
+        parts.append(text[last_end:start])
+        parts.append(value)
+        last_end = start - neg_length
+    if not parts:
+        return text
+    parts.append(text[last_end:])
+    return "".join(parts)
+
+
+def normalize_file(
+    path,
+    data,
+    apply,
+    backup,
+    backup_ext,
+    fix_utf8,
+    mapping,
+    apply_map_flag,
+    existing_backups=None,
+):
     label = classify(data)
-    if label in ("binary", "utf8-bom-invalid"):
-        return label, "skip", 0, 0
+    if label in _SKIP_LABELS:
+        return label, len(data), "skip", 0, 0
     try:
         text = decode_bytes(data, label)
         if text is None:
-            return label, "skip", 0, 0
+            return label, len(data), "skip", 0, 0
     except UnicodeDecodeError:
-        return label, "decode-error", 0, 0
+        return label, len(data), "decode-error", 0, 0
 
     before = mojibake_score(text)
+    after = before
     changed = False
 
     if fix_utf8:
-        text, did_fix = fix_utf8_in_cp1252(text)
+        text, did_fix, after = fix_utf8_in_cp1252(text, before)
         changed = changed or did_fix
 
     if apply_map_flag and mapping:
         mapped = apply_map(text, mapping)
         if mapped != text:
             text = mapped
+            after = mojibake_score(text)
             changed = True
 
-    after = mojibake_score(text)
-
     if not changed:
-        return label, "ok", before, after
+        return label, len(data), "ok", before, after
+
+    new_bytes = encode_text(text, label)
+    if new_bytes == data:
+        return label, len(data), "ok", before, after
 
     if not apply:
-        return label, "dry-run", before, after
+        return label, len(data), "dry-run", before, after
 
     if backup:
         backup_path = path.with_name(path.name + backup_ext)
-        if backup_path.exists():
-            return label, "backup-exists", before, after
+        if backup_exists(backup_path, existing_backups):
+            return label, len(data), "backup-exists", before, after
         backup_path.write_bytes(data)
 
-    path.write_bytes(encode_text(text, label))
-    return label, "write", before, after
+    write_bytes_atomic(path, new_bytes)
+    return label, len(new_bytes), "write", before, after
 
 
 def main():
@@ -219,6 +254,18 @@ def main():
         default=[".bas", ".cls"],
         help="Extensions to scan when no files are provided.",
     )
+    parser.add_argument(
+        "--exclude-dir",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Directory name to skip when scanning (repeatable). VCS, cache and venv directories are always skipped.",
+    )
+    parser.add_argument(
+        "--include-hidden",
+        action="store_true",
+        help="Also scan directories whose name starts with a dot.",
+    )
     parser.add_argument(
         "--apply",
         action="store_true",
@@ -260,6 +307,7 @@ def main():
     )
     args = parser.parse_args()
 
+    existing_backups = None
     if args.files:
         paths = [Path(p) for p in args.files]
     else:
@@ -267,11 +315,19 @@ def main():
         if not root.exists():
             print(f"root-not-found: {root}", file=sys.stderr)
             return 2
-        paths = gather_files(root, args.extensions)
+        paths, existing_backups = gather_files_and_backups(
+            root,
+            normalize_extensions(args.extensions),
+            args.backup_ext,
+            DEFAULT_EXCLUDE_DIRS | frozenset(args.exclude_dir),
+            args.include_hidden,
+        )
 
     if not paths:
         print("no-files-found", file=sys.stderr)
         return 2
+    if args.files:
+        paths = [path for path in paths if path.is_file()]
 
     mapping = {}
     apply_map_flag = False
@@ -286,40 +342,41 @@ def main():
         mapping = None
 
     results = []
-    for path in paths:
-        if not path.is_file():
-            continue
+    for path, read in read_files(paths):
         try:
-            label, action, before, after = normalize_file(
+            label, size, action, before, after = normalize_file(
                 path,
+                read.result(),
                 args.apply,
                 args.backup,
                 args.backup_ext,
                 not args.no_fix_utf8,
                 mapping,
                 apply_map_flag,
+                existing_backups,
             )
         except Exception:
-            label, action, before, after = "unknown", "error", 0, 0
-        results.append((path, path.stat().st_size, label, action, before, after))
-
-    print("file\tbytes\tclass\taction\tmojibake_before\tmojibake_after")
-    for path, size, label, action, before, after in results:
-        print(f"{path}\t{size}\t{label}\t{action}\t{before}\t{after}")
-
-    class_counts = {}
-    action_counts = {}
-    for _, _, label, action, _, _ in results:
-        class_counts[label] = class_counts.get(label, 0) + 1
-        action_counts[action] = action_counts.get(action, 0) + 1
-
-    print("\nsummary:")
-    for label in sorted(class_counts):
-        print(f"class_{label}\t{class_counts[label]}")
-    for action in sorted(action_counts):
-        print(f"action_{action}\t{action_counts[action]}")
-
-    problems = action_counts.get("skip", 0) + action_counts.get("decode-error", 0) + action_counts.get("error", 0)
+            label, size, action, before, after = "unknown", path.stat().st_size, "error", 0, 0
+        results.append((path, size, label, action, before, after))
+    if not args.files:
+        results.sort(key=lambda result: result[0])
+
+    lines = ["file\tbytes\tclass\taction\tmojibake_before\tmojibake_after"]
+    lines.extend(
+        f"{path}\t{size}\t{label}\t{action}\t{before}\t{after}"
+        for path, size, label, action, before, after in results
+    )
+    sys.stdout.write("\n".join(lines) + "\n")
+
+    class_counts = Counter(result[2] for result in results)
+    action_counts = Counter(result[3] for result in results)
+
+    lines = ["", "summary:"]
+    lines.extend(f"class_{label}\t{class_counts[label]}" for label in sorted(class_counts))
+    lines.extend(f"action_{action}\t{action_counts[action]}" for action in sorted(action_counts))
+    sys.stdout.write("\n".join(lines) + "\n")
+
+    problems = action_counts["skip"] + action_counts["decode-error"] + action_counts["error"]
     if args.strict and problems:
         return 1
     return 0
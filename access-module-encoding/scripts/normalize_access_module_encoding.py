@@ -1,92 +1,49 @@
 #!/usr/bin/env python
 import argparse
+from collections import Counter
 from pathlib import Path
 import sys
 
+from _encoding_core import (
+    DEFAULT_EXCLUDE_DIRS,
+    backup_exists,
+    classify,
+    decode_bytes,
+    gather_files_and_backups,
+    normalize_extensions,
+    read_files,
+    write_bytes_atomic,
+)
 
-def _classify_bytes(data):
-    if data.startswith(b"\xef\xbb\xbf"):
-        try:
-            data[3:].decode("utf-8")
-            return "utf8-bom", data[3:]
-        except UnicodeDecodeError:
-            return "utf8-bom-invalid", data[3:]
-    if data.startswith(b"\xff\xfe"):
-        return "utf16-le", data
-    if data.startswith(b"\xfe\xff"):
-        return "utf16-be", data
-    if b"\x00" in data:
-        return "binary", data
-    try:
-        data.decode("utf-8")
-        return "utf8", data
-    except UnicodeDecodeError:
-        return "ansi-cp1252", data
-
-
-def classify(data):
-    label, payload = _classify_bytes(data)
-    if label in ("utf8", "ansi-cp1252"):
-        if not any(b >= 0x80 for b in payload):
-            return "ascii-only"
-    return label
-
-
-def decode_bytes(data, label):
-    if label == "utf8":
-        return data.decode("utf-8")
-    if label == "utf8-bom":
-        return data.decode("utf-8-sig")
-    if label == "ascii-only":
-        return data.decode("ascii")
-    if label == "ansi-cp1252":
-        return data.decode("cp1252")
-    if label in ("utf16-le", "utf16-be"):
-        return data.decode("utf-16")
-    return None
-
-
-def gather_files(root, extensions):
-    exts = []
-    for ext in extensions:
-        ext = ext.strip()
-        if not ext:
-            continue
-        if not ext.startswith("."):
-            ext = "." + ext
-        exts.append(ext.lower())
-    files = []
-    for ext in exts:
-        files.extend(root.rglob(f"*{ext}"))
-    return sorted(set(files))
-
-
-def normalize_file(path, dry_run, backup, backup_ext):
-    data = path.read_bytes()
+
+_SKIP_LABELS = frozenset({"binary", "utf8-bom-invalid"})
+
+
+def normalize_file(path, data, dry_run, backup, backup_ext, existing_backups=None):
     label = classify(data)
-    if label in ("binary", "utf8-bom-invalid"):
-        return label, "skip"
+    if label in _SKIP_LABELS:
+        return label, len(data), "skip"
     try:
         text = decode_bytes(data, label)
         if text is None:
-            return label, "skip"
+            return label, len(data), "skip"
     except UnicodeDecodeError:
-        return label, "decode-error"
+        return label, len(data), "decode-error"
 
     new_bytes = text.encode("utf-8")
     if new_bytes == data:
-        return label, "ok"
+        return label, len(data), "ok"
     if dry_run:
-        return label, "dry-run"
+        return label, len(data), "dry-run"
 
     if backup:
         backup_path = path.with_name(path.name + backup_ext)
-        if backup_path.exists():
-            return label, "backup-exists"
+        if backup_exists(backup_path, existing_backups):
+            return label, len(data), "backup-exists"
         backup_path.write_bytes(data)
 
-    path.write_bytes(new_bytes)
-    return label, "write"
+    write_bytes_atomic(path, new_bytes)
+    return label, len(new_bytes), "write"
 
 
 def main():
@@ -109,6 +66,18 @@ def main():
         default=[".bas", ".cls"],
         help="Extensions to scan when no files are provided.",
     )
+    parser.add_argument(
+        "--exclude-dir",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Directory name to skip when scanning (repeatable). VCS, cache and venv directories are always skipped.",
+    )
+    parser.add_argument(
+        "--include-hidden",
+        action="store_true",
+        help="Also scan directories whose name starts with a dot.",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -131,6 +100,7 @@ def main():
     )
     args = parser.parse_args()
 
+    existing_backups = None
     if args.files:
         paths = [Path(p) for p in args.files]
     else:
@@ -138,39 +108,50 @@ def main():
         if not root.exists():
             print(f"root-not-found: {root}", file=sys.stderr)
             return 2
-        paths = gather_files(root, args.extensions)
+        paths, existing_backups = gather_files_and_backups(
+            root,
+            normalize_extensions(args.extensions),
+            args.backup_ext,
+            DEFAULT_EXCLUDE_DIRS | frozenset(args.exclude_dir),
+            args.include_hidden,
+        )
 
     if not paths:
         print("no-files-found", file=sys.stderr)
         return 2
+    if args.files:
+        paths = [path for path in paths if path.is_file()]
 
     results = []
-    for path in paths:
-        if not path.is_file():
-            continue
+    for path, read in read_files(paths):
         try:
-            label, action = normalize_file(path, args.dry_run, args.backup, args.backup_ext)
+            label, size, action = normalize_file(
+                path,
+                read.result(),
+                args.dry_run,
+                args.backup,
+                args.backup_ext,
+                existing_backups,
+            )
         except Exception:
-            label, action = "unknown", "error"
-        results.append((path, path.stat().st_size, label, action))
-
-    print("file\tbytes\tclass\taction")
-    for path, size, label, action in results:
-        print(f"{path}\t{size}\t{label}\t{action}")
-
-    class_counts = {}
-    action_counts = {}
-    for _, _, label, action in results:
-        class_counts[label] = class_counts.get(label, 0) + 1
-        action_counts[action] = action_counts.get(action, 0) + 1
-
-    print("\nsummary:")
-    for label in sorted(class_counts):
-        print(f"class_{label}\t{class_counts[label]}")
-    for action in sorted(action_counts):
-        print(f"action_{action}\t{action_counts[action]}")
-
-    problems = action_counts.get("skip", 0) + action_counts.get("decode-error", 0) + action_counts.get("error", 0)
+            label, size, action = "unknown", path.stat().st_size, "error"
+        results.append((path, size, label, action))
+    if not args.files:
+        results.sort(key=lambda result: result[0])
+
+    lines = ["file\tbytes\tclass\taction"]
+    lines.extend(f"{path}\t{size}\t{label}\t{action}" for path, size, label, action in results)
+    sys.stdout.write("\n".join(lines) + "\n")
+
+    class_counts = Counter(result[2] for result in results)
+    action_counts = Counter(result[3] for result in results)
+
+    lines = ["", "summary:"]
+    lines.extend(f"class_{label}\t{class_counts[label]}" for label in sorted(class_counts))
+    lines.extend(f"action_{action}\t{action_counts[action]}" for action in sorted(action_counts))
+    sys.stdout.write("\n".join(lines) + "\n")
+
+    problems = action_counts["skip"] + action_counts["decode-error"] + action_counts["error"]
     if args.strict and problems:
         return 1
     return 0